@@ -3,11 +3,81 @@ import os
 import sys
 import json
 import argparse
-from datetime import datetime
-import requests
+import time
 import re
+import ast
 import subprocess
+import tempfile
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, Future
 from typing import Dict, List, Any, Tuple
+try:
+    from rapidfuzz import fuzz    # optional: C edit distance for output matching
+except ImportError:
+    fuzz = None
+
+def edit_similarity(a: str, b: str) -> float:
+    """
+    Normalized InDel similarity of two strings, from 0 to 1:
+    2 * LCS / (len(a) + len(b)), the same value as rapidfuzz's fuzz.ratio.
+    """
+    if fuzz:
+        return fuzz.ratio(a, b) / 100
+    if not a and not b:
+        return 1.0
+    # Longest common subsequence, one row at a time; outputs are short
+    if len(b) > len(a):
+        a, b = b, a
+    row = [0] * (len(b) + 1)
+    for ca in a:
+        diag = 0
+        for j, cb in enumerate(b, 1):
+            diag, row[j] = row[j], diag + 1 if ca == cb else max(row[j], row[j - 1])
+    return 2 * row[-1] / (len(a) + len(b))
+
+# AST node types for the required_elements of python_syntax criteria.
+# Matching on the parse tree ignores keywords inside strings and comments.
+PYTHON_ELEMENTS = {
+    'function_definition': (ast.FunctionDef, ast.AsyncFunctionDef),
+    'while_loop': (ast.While,),
+    'for_loop': (ast.For, ast.AsyncFor),
+    'if_statement': (ast.If,),
+}
+# Patterns for microbit_blocks criteria, combined at import into a single
+# alternation so one scan of the code finds every element present
+MICROBIT_ELEMENTS = {
+    'microbit_import': r'from\s+microbit\s+import',
+    'display_image': r'display\.(?:show|scroll|get_pixel|set_pixel)',
+    'button_input': r'button_[ab]\.(?:was_pressed|is_pressed|get_presses)',
+}
+MICROBIT_PATTERN = re.compile('|'.join(
+    f'(?P<{element}>{pattern})' for element, pattern in MICROBIT_ELEMENTS.items()))
+# Canonically spaced spellings, each a sure match for its element. Plain
+# substring tests settle most submissions without running the regex.
+MICROBIT_LITERALS = {
+    'microbit_import': ('from microbit import',),
+    'display_image': ('display.show', 'display.scroll', 'display.get_pixel',
+                      'display.set_pixel'),
+    'button_input': tuple(f'button_{b}.{m}' for b in 'ab'
+                          for m in ('was_pressed', 'is_pressed', 'get_presses')),
+}
+
+@functools.lru_cache(maxsize=8)
+def python_node_types(code: str) -> frozenset:
+    """
+    Parse code once and return the AST node types it contains; every
+    python_syntax criterion on the same submission shares the result.
+    Raises SyntaxError (not cached) if the code doesn't compile.
+    """
+    tree = ast.parse(code)
+    # ast.parse accepts e.g. 'break' outside a loop; compiling the tree
+    # reports the same errors compile() on the source would
+    compile(tree, '<string>', 'exec')
+    return frozenset(type(node) for node in ast.walk(tree))
+
+# Score at the start of an ai_review reply, e.g. "35 Good use of loops"
+LEADING_SCORE = re.compile(r'\s*(\d+(?:\.\d+)?)', re.ASCII)
 
 class AutoGrader:
     def __init__(self, config_path: str):
@@ -18,16 +88,38 @@ class AutoGrader:
         self.notion_students_db = os.getenv('NOTION_STUDENTS_DATABASE_ID')
         self.debug = os.getenv('DEBUG', '0') == '1'
         self.codio_env = self._parse_codio_env()
+        # One run per distinct code, shared by all output_match criteria
+        self._code_runs: Dict[str, Future] = {}
+        self._code_runs_lock = threading.Lock()
+        # Reuse connections across the OpenAI and Notion requests; the pool
+        # is sized for concurrently evaluated criteria
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.session = requests.Session()
+        # Completions are billed, so POSTs are only retried when rate
+        # limited, never after a read timeout or 5xx that may follow a
+        # request that went through.
+        # Student lookups are read-only queries and retry on any failure.
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=4, pool_maxsize=20,
+            max_retries=Retry(total=3, read=0, backoff_factor=0.3,
+                              status_forcelist=[429], allowed_methods=["POST"])))
+        self.session.mount('https://api.notion.com/v1/databases/', HTTPAdapter(
+            pool_connections=1, pool_maxsize=20,
+            max_retries=Retry(total=3, backoff_factor=0.3,
+                              status_forcelist=[429, 500, 502, 503, 504],
+                              allowed_methods=["POST"])))
 
     def _parse_codio_env(self) -> Dict:
         """Parse Codio environment variables if available"""
-        codio_env_json = os.getenv('CODIO_AUTOGRADE_ENV')
-        if not codio_env_json:
+        if not os.getenv('CODIO_AUTOGRADE_ENV'):
             self.log("Not running in Codio environment")
             return {}
         
         try:
-            return json.loads(codio_env_json)
+            # Shares the single cached parse with grade()
+            return codio_env() or {}
         except Exception as e:
             self.log(f"Failed to parse CODIO_AUTOGRADE_ENV: {str(e)}")
             return {}
@@ -41,21 +133,19 @@ class AutoGrader:
         if self.debug:
             print(f"[DEBUG] {message}", file=sys.stderr)
 
-    def _check_environment(self) -> None:
-        """Verify all required environment variables are set"""
-        required_vars = {
-            'OPENAI_API_KEY': self.openai_key,
-        }
-        
+    def _missing_environment(self) -> List[str]:
+        """Names of required environment variables that are not set"""
+        required = [('OPENAI_API_KEY', self.openai_key)]
         # Only require Notion variables if Notion is enabled
         if self.config.get('notion', {}).get('enabled', False):
-            required_vars.update({
-                'NOTION_API_KEY': self.notion_key,
-                'NOTION_GRADES_DATABASE_ID': self.notion_grades_db,
-                'NOTION_STUDENTS_DATABASE_ID': self.notion_students_db
-            })
-            
-        missing = [k for k, v in required_vars.items() if not v]
+            required += [('NOTION_API_KEY', self.notion_key),
+                         ('NOTION_GRADES_DATABASE_ID', self.notion_grades_db),
+                         ('NOTION_STUDENTS_DATABASE_ID', self.notion_students_db)]
+        return [name for name, value in required if not value]
+
+    def _check_environment(self) -> None:
+        """Verify all required environment variables are set"""
+        missing = self._missing_environment()
         if missing:
             raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
 
@@ -92,6 +182,14 @@ class AutoGrader:
             'max_points': criterion['points']
         }
 
+    def _evaluate_criteria(self, criteria: List[Dict], code: str,
+                           concurrency: int = 10) -> List[Dict]:
+        """Evaluate criteria concurrently, returning results in criteria order"""
+        # AI reviews and output checks spend their time waiting on the network
+        # or a subprocess, so running them side by side is safe and much faster
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
+            return list(ex.map(lambda c: self._evaluate_criterion(c, code), criteria))
+
     def _ai_review(self, criterion: Dict, code: str) -> Tuple[float, str]:
         """Get AI review for code"""
         try:
@@ -108,7 +206,7 @@ class AutoGrader:
             
             api_url = f"{openai_base_url}/chat/completions" if openai_base_url else "https://api.openai.com/v1/chat/completions"
             
-            response = requests.post(
+            response = self.session.post(
                 api_url,
                 headers=headers,
                 json={
@@ -127,15 +225,12 @@ class AutoGrader:
             feedback = result['choices'][0]['message']['content']
             
             # Extract score from feedback if it starts with a number (as per system prompt)
-            try:
-                score_match = re.match(r'^\s*(\d+(\.\d+)?)', feedback)
-                if score_match:
-                    score = float(score_match.group(1))
-                    # Remove the score from the feedback
-                    feedback = feedback[score_match.end():].strip()
-                else:
-                    score = 0
-            except:
+            score_match = LEADING_SCORE.match(feedback)
+            if score_match:
+                score = float(score_match.group(1))
+                # Remove the score from the feedback
+                feedback = feedback[score_match.end():].strip()
+            else:
                 score = 0
                 
             return score, feedback
@@ -164,112 +259,103 @@ class AutoGrader:
 
     def _check_python_syntax(self, criterion: Dict, code: str) -> Tuple[float, str]:
         """Check Python syntax and required elements"""
-        # First, check if the code compiles
+        # First, check if the code parses; the tree also answers the element checks
         try:
-            compile(code, '<string>', 'exec')
+            node_types = python_node_types(code)
         except Exception as e:
             return 0, f"Syntax error: {str(e)}"
-            
-        # Check for required elements
-        required_elements = criterion.get('required_elements', [])
-        found_elements = []
-        missing_elements = []
-        
-        for element in required_elements:
-            if element == 'function_definition':
-                if re.search(r'def\s+\w+\s*\(', code):
-                    found_elements.append(element)
-                else:
-                    missing_elements.append(element)
-            elif element == 'while_loop':
-                if re.search(r'while\s+.+:', code):
-                    found_elements.append(element)
-                else:
-                    missing_elements.append(element)
-            elif element == 'for_loop':
-                if re.search(r'for\s+.+\s+in\s+.+:', code):
-                    found_elements.append(element)
-                else:
-                    missing_elements.append(element)
-            elif element == 'if_statement':
-                if re.search(r'if\s+.+:', code):
-                    found_elements.append(element)
-                else:
-                    missing_elements.append(element)
-            # Add more element checks as needed
-        
-        # Calculate score based on found elements
-        if not required_elements:
-            score = criterion['points']  # Full points if no specific elements required
-        else:
-            score = (len(found_elements) / len(required_elements)) * criterion['points']
-        
-        # Generate feedback
-        if missing_elements:
-            feedback = f"Missing required elements: {', '.join(missing_elements)}"
-        else:
-            feedback = "All required elements found"
-            
-        return score, feedback
+
+        return self._check_elements(
+            criterion, PYTHON_ELEMENTS,
+            lambda element: not node_types.isdisjoint(PYTHON_ELEMENTS[element]), "")
 
     def _check_microbit_syntax(self, criterion: Dict, code: str) -> Tuple[float, str]:
         """Check Microbit-specific code patterns"""
+        required = set(criterion.get('required_elements', [])) & MICROBIT_LITERALS.keys()
+        found = {element for element in required
+                 if any(literal in code for literal in MICROBIT_LITERALS[element])}
+        if required - found:
+            # Unusual spacing, or really missing - let the regex decide
+            found.update(match.lastgroup for match in MICROBIT_PATTERN.finditer(code))
+        return self._check_elements(criterion, MICROBIT_ELEMENTS, found.__contains__,
+                                    "Microbit ")
+
+    def _check_elements(self, criterion: Dict, checks: Dict, is_present,
+                        label: str) -> Tuple[float, str]:
+        """Score the criterion's required_elements, using is_present on each known one"""
         required_elements = criterion.get('required_elements', [])
         found_elements = []
         missing_elements = []
-        
-        # Check for microbit-specific imports and functions
-        if 'microbit_import' in required_elements:
-            if re.search(r'from\s+microbit\s+import', code):
-                found_elements.append('microbit_import')
-            else:
-                missing_elements.append('microbit_import')
-                
-        if 'display_image' in required_elements:
-            if re.search(r'display\.(show|scroll|get_pixel|set_pixel)', code):
-                found_elements.append('display_image')
-            else:
-                missing_elements.append('display_image')
-                
-        if 'button_input' in required_elements:
-            if re.search(r'button_(a|b)\.(was_pressed|is_pressed|get_presses)', code):
-                found_elements.append('button_input')
+        unknown_elements = []
+
+        for element in required_elements:
+            if element not in checks:
+                unknown_elements.append(element)
+            elif is_present(element):
+                found_elements.append(element)
             else:
-                missing_elements.append('button_input')
-                
+                missing_elements.append(element)
+
         # Calculate score based on found elements
         if not required_elements:
             score = criterion['points']  # Full points if no specific elements required
         else:
             score = (len(found_elements) / len(required_elements)) * criterion['points']
-        
+
         # Generate feedback
         if missing_elements:
-            feedback = f"Missing required Microbit elements: {', '.join(missing_elements)}"
+            feedback = f"Missing required {label}elements: {', '.join(missing_elements)}"
         else:
-            feedback = "All required Microbit elements found"
-            
+            feedback = f"All required {label}elements found"
+        if unknown_elements:
+            # A typo in the config shouldn't pass silently
+            self.log(f"Unknown required elements in config: {unknown_elements}")
+            feedback += f" (unknown elements in config: {', '.join(unknown_elements)})"
+
         return score, feedback
 
-    def _check_output(self, criterion: Dict, code: str) -> Tuple[float, str]:
-        """Check if code produces expected output"""
+    def _run_code(self, code: str) -> str:
+        """Run code in a separate interpreter once and return its stdout"""
+        with self._code_runs_lock:
+            run = self._code_runs.get(code)
+            owner = run is None
+            if owner:
+                run = self._code_runs[code] = Future()
+        if not owner:
+            # Another criterion is already running (or ran) this code
+            return run.result()
+
+        temp_path = None
         try:
-            # Create a temporary file to run the code
-            with open('temp_code.py', 'w') as f:
+            # Create a uniquely named temporary file to run the code. It goes
+            # in the working directory, as temp_code.py did, so imports of
+            # the student's other files and __file__ still resolve there
+            with tempfile.NamedTemporaryFile('w', suffix='.py', dir=os.getcwd(),
+                                             delete=False) as f:
                 f.write(code)
-            
+                temp_path = f.name
+
             # Run the code and capture output
             result = subprocess.run(
-                ['python3', 'temp_code.py'], 
+                ['python3', temp_path], 
                 capture_output=True, 
                 text=True, 
                 timeout=5  # 5 second timeout
             )
-            
-            # Clean up temp file
-            os.remove('temp_code.py')
-            
-            actual_output = result.stdout.strip()
+            run.set_result(result.stdout)
+        except Exception as e:
+            # Timeouts are shared too, rather than re-run for 5s each
+            run.set_exception(e)
+        finally:
+            # Clean up temp file, including after a timeout
+            if temp_path:
+                os.remove(temp_path)
+        return run.result()
+
+    def _check_output(self, criterion: Dict, code: str) -> Tuple[float, str]:
+        """Check if code produces expected output"""
+        try:
+            actual_output = self._run_code(code).strip()
             expected_output = criterion.get('expected', '').strip()
             
             # Check for exact match
@@ -283,8 +369,7 @@ class AutoGrader:
                 if max_len == 0:
                     similarity = 0
                 else:
-                    # Calculate Levenshtein distance (simplified approach)
-                    similarity = 1 - (abs(len(actual_output) - len(expected_output)) / max_len)
+                    similarity = edit_similarity(actual_output, expected_output)
                     
                     # Additional factors to consider
                     if expected_output in actual_output:
@@ -310,6 +395,17 @@ class AutoGrader:
             self.log(f"Output check failed: {str(e)}")
             return 0, f"Failed to check output: {str(e)}"
 
+    def _find_student_in_notion(self, student_email: str, headers: Dict):
+        """Look up a student's page ID by email with a single filtered query"""
+        response = self.session.post(
+            f"https://api.notion.com/v1/databases/{self.notion_students_db}/query",
+            headers=headers,
+            json={"filter": {"property": "Email", "email": {"equals": student_email.lower()}},
+                  "page_size": 1}
+        )
+        results = response.json().get('results', [])
+        return results[0]['id'] if results else None
+
     def _post_to_notion(self, results: Dict) -> None:
         """Post results to Notion database"""
         try:
@@ -332,7 +428,7 @@ class AutoGrader:
             grade_topic_id = self.config.get('notion', {}).get('grade_topic_id', '')
             
             # Find student page in Notion
-            student_page_id = self._find_student_in_notion(student_email)
+            student_page_id = self._find_student_in_notion(student_email, headers)
             if not student_page_id:
                 self.log(f"Student not found in Notion: {student_email}")
                 return
@@ -341,7 +437,7 @@ class AutoGrader:
             properties = {
                 "Name": {"title": [{"text": {"content": self.config['assignment']['name']}}]},
                 "Student": {"relation": [{"id": student_page_id}]},
-                "Date": {"date": {"start": datetime.utcnow().isoformat()}},
+                "Date": {"date": {"start": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}},
                 "Total": {"number": self.config['assignment']['points_possible']},
                 "Score": {"number": results['total_score']},
                 "Grade Topic": {"relation": [{"id": grade_topic_id}]}
@@ -355,6 +451,8 @@ class AutoGrader:
                         
                     value = template
                     value = value
+        except Exception as e:
+            self.log(f"Notion post failed: {str(e)}")
 
 #!/usr/bin/env python3
 """
@@ -371,6 +469,9 @@ OPENAI_BASE_URL            - Base URL for OpenAI API
 
 CODIO_AUTOGRADE_ENV        - set by Codio (absent when testing locally)
 DEBUG                      - optional, set to "1" to enable debug logging
+GRADER_CACHE_TTL           - optional, seconds to reuse cached responses
+                             (default 86400; 0 disables the cache; never
+                             used in Codio)
 
 # The following are optional. If absent, Notion calls are skipped.
 NOTION_API_KEY
@@ -378,28 +479,14 @@ NOTION_GRADES_DATABASE_ID
 NOTION_STUDENTS_DATABASE_ID
 """
 
-import os, sys, json, textwrap, pathlib, requests
-from datetime import datetime
+import os, sys, io, re, json, pathlib, hashlib, time, random, functools, tokenize, threading
 from time import perf_counter
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 
-# ------------------------------------------------------------
-# Notion configuration
-# Hardcoded for Codio autograding environment, but can be overridden
-# by environment variables if needed. These values are secure as:
-# 1. They're only in the .guides/secure directory (students can't access)
-# 2. The GitHub repository is private
-# ------------------------------------------------------------
-NOTION_CONFIG = {
-    "API_KEY": "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",
-    "GRADES_DB": "19c2fa9286478146942df2be3193a18d",
-    "STUDENTS_DB": "19c2fa9286478121a858f58796de39a9"
-}
-
-# Allow environment variable override if needed
-NOTION_API_KEY = os.getenv("NOTION_API_KEY", NOTION_CONFIG["API_KEY"])
-NOTION_GRADES_DATABASE_ID = os.getenv("NOTION_GRADES_DATABASE_ID", NOTION_CONFIG["GRADES_DB"])
-NOTION_STUDENTS_DATABASE_ID = os.getenv("NOTION_STUDENTS_DATABASE_ID", NOTION_CONFIG["STUDENTS_DB"])
+try:
+    import orjson                 # optional: faster JSON encode/decode
+except ImportError:
+    orjson = None
 
 # ------------------------------------------------------------
 # Minimal logger – write to stderr only when DEBUG env var is true
@@ -410,53 +497,290 @@ def log(msg: str):
     if DEBUG:
         print(f"[DEBUG] {msg}", file=sys.stderr)
 
-# Log Notion configuration if debug enabled
-if DEBUG:
-    log(f"Notion API Key: {NOTION_API_KEY[:5]}...{NOTION_API_KEY[-5:]}")
-    log(f"Notion Grades DB: {NOTION_GRADES_DATABASE_ID}")
-    log(f"Notion Students DB: {NOTION_STUDENTS_DATABASE_ID}")
+# ------------------------------------------------------------
+# JSON helpers - orjson when it's installed, stdlib json otherwise
+# ------------------------------------------------------------
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def json_dumps(obj, indent:bool=False) -> bytes:
+    """Serialize straight to UTF-8 bytes, ready for a request body or stdout."""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode()
+
+def write_atomic(path:pathlib.Path, data:bytes):
+    """
+    Write then rename, so a concurrent reader (batch chunks run on threads,
+    several runs may share a home) never sees a half-written cache file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
 
 # ------------------------------------------------------------
 # Configuration helpers
 # ------------------------------------------------------------
+@functools.lru_cache(maxsize=32)
+def _load_config_cached(path:str, mtime_ns:int, size:int) -> dict:
+    return json_loads(pathlib.Path(path).read_bytes())
+
 def load_config(fname="autograde_config.json"):
-    with open(fname, "r") as cf:
-        return json.load(cf)
+    # Keyed on mtime and size so an edited config is re-read, an unchanged one isn't
+    st = os.stat(fname)
+    return _load_config_cached(fname, st.st_mtime_ns, st.st_size)
 
-def load_code(file_list):
+def compress_code(src:str) -> str:
+    """
+    Drop # comments and repeated blank lines from Python source to save
+    prompt tokens. Lines inside strings are left alone, and source that
+    doesn't tokenize is returned unchanged so the model still sees exactly
+    what the student wrote.
+    """
+    # Split only on "\n" as tokenize does; splitlines() would also break
+    # on e.g. form feeds and throw the token rows out of line
+    lines = src.split("\n")
+    comment_only, blank = set(), set()
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(src).readline):
+            row = tok.start[0] - 1
+            if tok.type == tokenize.COMMENT:
+                code_part = lines[row][:tok.start[1]].rstrip()
+                if not code_part:
+                    comment_only.add(row)
+                lines[row] = code_part
+            # NL tokens never come from inside a string, so only these
+            # blank lines may be collapsed
+            elif tok.type == tokenize.NL and row < len(lines) and not tok.line.strip():
+                blank.add(row)
+    except (tokenize.TokenError, SyntaxError):
+        return src
+    out = []
+    prev_blank = True                 # also drops leading blank lines
+    for i, line in enumerate(lines):
+        if i in comment_only or (i in blank and prev_blank):
+            continue
+        prev_blank = i in blank
+        out.append("" if prev_blank else line)
+    return "\n".join(out).strip("\n") + "\n"
+
+def truncate_code(text:str, max_chars:int) -> str:
+    """Keep the first 75% and last 25% of max_chars of an oversized file."""
+    if len(text) <= max_chars:
+        return text
+    head = max_chars * 3 // 4
+    return f"{text[:head]}\n# ... [truncated] ...\n{text[-(max_chars - head):]}"
+
+@functools.lru_cache(maxsize=32)
+def _load_file_cached(fn:str, mtime_ns:int, size:int, strip_comments:bool,
+                      max_chars:int) -> str:
+    # A stray non-UTF-8 byte (pasted text, odd editor) shouldn't stop grading
+    text = pathlib.Path(fn).read_bytes().decode("utf-8", errors="replace")
+    if strip_comments and fn.endswith(".py"):
+        text = compress_code(text)
+    if max_chars:
+        text = truncate_code(text, max_chars)
+    return text
+
+def load_code(file_list, strip_comments:bool=True, max_chars:int=None):
     buf = []
     for fn in file_list:
-        p = pathlib.Path(fn)
-        if not p.exists() or p.stat().st_size == 0:
+        # One stat tells us whether the file exists, whether it's empty and
+        # whether the processed copy from an earlier call is still current
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            st = None
+        if st is None or not st.st_size:
             raise FileNotFoundError(f"Required file missing or empty: {fn}")
-        buf.append(f"# === {fn} ===\n{p.read_text()}")
-    return "\n\n".join(buf)
+        text = _load_file_cached(fn, st.st_mtime_ns, st.st_size, strip_comments, max_chars)
+        # Header and code go in as separate parts so the code is only
+        # copied once, by the final join
+        buf.append(f"\n\n# === {fn} ===\n" if buf else f"# === {fn} ===\n")
+        buf.append(text)
+    return "".join(buf)
 
 # ------------------------------------------------------------
 # OpenAI API handling - simplified to use completions
 # ------------------------------------------------------------
-# Initialize the OpenAI client with default settings
+# Initialize the OpenAI client
 # Note: Codio sets OPENAI_API_KEY and OPENAI_BASE_URL automatically
-openai_client = OpenAI()
+# The SDK retries rate limits, timeouts, connection errors and 5xx responses
+# with jittered exponential backoff (0.5s doubling, capped at 8s) and raises
+# auth/bad-request errors straight away, so no retry loop is needed here.
+# The timeout replaces the SDK's 10 minute default, which would outlast
+# Codio's grading window on a hung request.
+OPENAI_MAX_RETRIES = 2
+OPENAI_TIMEOUT = 60
+
+@functools.lru_cache(maxsize=1)
+def openai_client():
+    """Build the client on first use - cache hits never need one."""
+    # The SDK takes the better part of a second to import, so it is only
+    # loaded once a request actually has to be made
+    from openai import OpenAI
+    return OpenAI(max_retries=OPENAI_MAX_RETRIES, timeout=OPENAI_TIMEOUT)
 DEFAULT_MODEL = "gpt-4.1-nano-2025-04-14"
 
-def call_openai(system_msg:str, user_msg:str, model:str=None) -> str:
-    """Call OpenAI completions API and return the response text."""
+# Structured outputs: the API itself guarantees the verdict is exactly
+# "yes" or "no", and the schema's property order keeps the verdict first
+_VERDICT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "verdict": {"type": "string", "enum": ["yes", "no"]},
+        "feedback": {"type": "string"}
+    },
+    "required": ["verdict", "feedback"],
+    "additionalProperties": False
+}
+GRADE_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {
+    "name": "grade", "strict": True, "schema": _VERDICT_SCHEMA}}
+BATCH_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {
+    "name": "batch_grades", "strict": True, "schema": {
+        "type": "object",
+        "properties": {"results": {"type": "array", "items": {
+            "type": "object",
+            "properties": {"id": {"type": "string"}, **_VERDICT_SCHEMA["properties"]},
+            "required": ["id", "verdict", "feedback"],
+            "additionalProperties": False}}},
+        "required": ["results"],
+        "additionalProperties": False}}}
+
+# ------------------------------------------------------------
+# On-disk response cache - identical requests (e.g. re-grading unchanged
+# code locally) are answered without another API round-trip. Not used in
+# Codio, where the cache would sit in the student's writable home.
+# ------------------------------------------------------------
+class ResponseCache:
+    """One JSON file per (system_msg, user_msg, model, options) under ~/.cache/codio-grader."""
+
+    def __init__(self, root=None, ttl:float=24 * 3600):
+        self.root = pathlib.Path(root) if root else pathlib.Path.home() / ".cache" / "codio-grader"
+        self.ttl = ttl
+
+    def _path(self, system_msg:str, user_msg:str, model:str,
+              options:dict=None) -> pathlib.Path:
+        # Request options (max_tokens, response_format, ...) shape the reply,
+        # so e.g. raising the token limit must not serve a cut-short answer
+        opts = json.dumps(options or {}, sort_keys=True)
+        key = hashlib.sha256(f"{system_msg}\0{user_msg}\0{model}\0{opts}".encode()).hexdigest()
+        return self.root / f"{key}.json"
+
+    def get(self, system_msg:str, user_msg:str, model:str, options:dict=None):
+        """Return the cached response text, or None on a miss or expired entry."""
+        try:
+            entry = json_loads(self._path(system_msg, user_msg, model, options).read_bytes())
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get("created_at", 0) > self.ttl:
+            return None
+        return entry.get("response")
+
+    def put(self, system_msg:str, user_msg:str, model:str, response:str,
+            options:dict=None):
+        entry = {"response": response, "created_at": time.time(), "model": model}
+        try:
+            write_atomic(self._path(system_msg, user_msg, model, options), json_dumps(entry))
+        except OSError as e:          # a read-only home must not fail grading
+            log(f"Could not write response cache: {e}")
+
+def _cache_ttl(default:float=24 * 3600) -> float:
+    """GRADER_CACHE_TTL in seconds; a bad value must not stop grading."""
+    raw = os.getenv("GRADER_CACHE_TTL")
+    if raw is None:
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        log(f"Ignoring invalid GRADER_CACHE_TTL {raw!r}, using {default:.0f}s")
+        return default
+
+response_cache = ResponseCache(ttl=_cache_ttl())
+
+def _log_usage(usage):
+    """Log token counts, including how much of the prompt hit OpenAI's cache."""
+    if not DEBUG or usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    log(f"Tokens: {usage.prompt_tokens} prompt ({cached} cached), "
+        f"{usage.completion_tokens} completion")
+
+def call_openai(system_msg:str, user_msg:str, model:str=None,
+                use_cache:bool=True, stream:bool=False, max_tokens:int=None,
+                response_format:dict=None, stop_when=None) -> str:
+    """
+    Call OpenAI completions API and return the response text.
+
+    With stream=True the tokens are echoed to stderr as they arrive so local
+    runs show progress; the full text is still returned at the end.
+    max_tokens caps the generated output when given, and response_format
+    (e.g. GRADE_RESPONSE_FORMAT) constrains the reply to a JSON schema.
+
+    stop_when is an optional predicate on the text received so far; the
+    response is streamed and closed as soon as it returns True, and the
+    partial text is returned.
+    """
     model = model or DEFAULT_MODEL
+    options = {"max_tokens": max_tokens} if max_tokens else {}
+    if response_format:
+        options["response_format"] = response_format
+    # Students can write to the cache directory in Codio, so a cached
+    # verdict there can't be trusted
+    use_cache = use_cache and response_cache.ttl > 0 and not in_codio()
+    # A reply closed early by stop_when is partial; keep it apart from full ones
+    cache_key = dict(options, stop_early=stop_when is not None)
+    if use_cache:
+        cached = response_cache.get(system_msg, user_msg, model, cache_key)
+        if cached is not None:
+            log("Using cached OpenAI response")
+            return cached
     log(f"Calling OpenAI API with model: {model}")
     
+    if DEBUG and (stream or stop_when is not None):
+        # Usage arrives in a final, choice-less chunk. Only asked for when
+        # it will be logged: SDKs before 1.26 reject stream_options, and
+        # Codio boxes don't install requirements.txt
+        options["stream_options"] = {"include_usage": True}
     try:
         # Using the OpenAI completions API
-        response = openai_client.chat.completions.create(
+        response = openai_client().chat.completions.create(
             model=model,
             messages=[
                 {"role": "system", "content": system_msg},
                 {"role": "user", "content": user_msg}
             ],
-            temperature=0.1
+            temperature=0.1,
+            stream=stream or stop_when is not None,
+            **options
         )
-        result = response.choices[0].message.content.strip()
+        if stream or stop_when is not None:
+            parts = []
+            try:
+                for chunk in response:
+                    if getattr(chunk, "usage", None):
+                        _log_usage(chunk.usage)
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        parts.append(delta)
+                        if stream:
+                            print(delta, end="", file=sys.stderr, flush=True)
+                        if stop_when is not None and stop_when("".join(parts)):
+                            log("Stopping response early")
+                            break
+            finally:
+                # Closing the connection also stops generation server-side
+                response.close()
+                if stream:
+                    print(file=sys.stderr)
+            result = "".join(parts).strip()
+        else:
+            _log_usage(response.usage)
+            result = response.choices[0].message.content.strip()
         log(f"API response received: {result[:50]}...")
+        if use_cache:
+            response_cache.put(system_msg, user_msg, model, result, cache_key)
         return result
     except Exception as e:
         error_msg = str(e)
@@ -467,29 +791,149 @@ def call_openai(system_msg:str, user_msg:str, model:str=None) -> str:
 # ------------------------------------------------------------
 # Codio helpers (loaded lazily so local runs don't fail)
 # ------------------------------------------------------------
+@functools.lru_cache(maxsize=1)
+def codio_env():
+    """
+    The parsed CODIO_AUTOGRADE_ENV, or None outside Codio. Parsed once;
+    malformed JSON gives {} so grading still reaches codio_send.
+    """
+    raw = os.getenv("CODIO_AUTOGRADE_ENV")
+    if not raw:
+        return None
+    try:
+        return json_loads(raw)
+    except ValueError as e:
+        log(f"Failed to parse CODIO_AUTOGRADE_ENV: {e}")
+        return {}
+
 def in_codio() -> bool:
+    # Presence only; the JSON is parsed where the student email is read
     return bool(os.getenv("CODIO_AUTOGRADE_ENV"))
 
-def codio_send(grade:int, feedback:str):
-    # Import only when really in Codio
+@functools.lru_cache(maxsize=1)
+def _codio_grade_api():
+    # Import only when really in Codio, and only once per process
     sys.path.append("/usr/share/codio/assessments")
     from lib.grade import send_grade_v2, FORMAT_V2_MD
-    return send_grade_v2(grade, feedback, FORMAT_V2_MD)
+    return send_grade_v2, FORMAT_V2_MD
+
+def codio_send(grade:int, feedback:str):
+    send_grade_v2, fmt = _codio_grade_api()
+    return send_grade_v2(grade, feedback, fmt)
 
 # ------------------------------------------------------------
 # Notion integration for tracking submissions
 # ------------------------------------------------------------
+@functools.lru_cache(maxsize=1)
+def notion_credentials():
+    """
+    (api_key, grades_db, students_db) from the environment, read on first use.
+    Any of them may be None, in which case Notion logging is skipped.
+    """
+    key = os.getenv("NOTION_API_KEY")
+    db_gr = os.getenv("NOTION_GRADES_DATABASE_ID")
+    db_st = os.getenv("NOTION_STUDENTS_DATABASE_ID")
+    if key:
+        log(f"Notion API Key: {key[:5]}...{key[-5:]}")
+    log(f"Notion Grades DB: {db_gr}")
+    log(f"Notion Students DB: {db_st}")
+    return key, db_gr, db_st
+
+# Single worker for Notion requests that run alongside the grading call
+# and the Codio submission; per-request timeouts keep it from hanging
+_notion_executor = ThreadPoolExecutor(max_workers=1)
+NOTION_TIMEOUT = (3.05, 10)       # connect, read seconds per request
+NOTION_WAIT_SECONDS = 5           # how long grade() waits before exiting
+
+@functools.lru_cache(maxsize=1)
+def notion_session():
+    """
+    One keep-alive session for all Notion calls, so the student lookup and
+    the page creation share a connection instead of a TLS handshake each.
+    Built on first use; local runs never import requests at all.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {notion_credentials()[0]}",
+        "Notion-Version": "2022-06-28",
+        "Content-Type": "application/json"
+    })
+    # Database queries are read-only and safe to repeat on any failure.
+    # A page create may already have happened when the reply times out or
+    # is a 5xx, so it is only retried when rate limited (nothing written).
+    session.mount("https://api.notion.com", HTTPAdapter(
+        pool_connections=2, pool_maxsize=4,
+        max_retries=Retry(total=3, read=0, backoff_factor=0.3,
+                          status_forcelist=[429], allowed_methods=["POST"])))
+    session.mount("https://api.notion.com/v1/databases/", HTTPAdapter(
+        pool_connections=2, pool_maxsize=4,
+        max_retries=Retry(total=3, backoff_factor=0.3,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=["POST"])))
+    return session
+
+# Student page IDs never change, so remember them between local runs,
+# keyed by students database and email. Not persisted in Codio, where the
+# file would sit in the student's writable home and could be remapped.
+_STUDENT_ID_CACHE_FILE = response_cache.root / "notion_students.json"
+
+@functools.lru_cache(maxsize=1)
+def _student_id_cache() -> dict:
+    if in_codio():
+        return {}
+    try:
+        return json_loads(_STUDENT_ID_CACHE_FILE.read_bytes())
+    except (OSError, ValueError):
+        return {}
+
+def find_student_page(student_email:str):
+    """Return the Notion page ID of the student with this email, or None."""
+    email = student_email.lower()
+    students_db = notion_credentials()[2]
+    key = f"{students_db}/{email}"
+    cache = _student_id_cache()
+    if key in cache:
+        return cache[key]
+
+    # Let Notion match the email server-side instead of paging through
+    # every student in the database
+    qurl = f"https://api.notion.com/v1/databases/{students_db}/query"
+    body = {"filter": {"property": "Email", "email": {"equals": email}},
+            "page_size": 1}
+    resp = json_loads(notion_session().post(qurl, data=json_dumps(body),
+                                            timeout=NOTION_TIMEOUT).content)
+    results = resp.get("results", [])
+    if not results:                   # don't cache misses; they may be added later
+        return None
+
+    cache[key] = results[0]["id"]
+    if not in_codio():
+        try:
+            write_atomic(_STUDENT_ID_CACHE_FILE, json_dumps(cache))
+        except OSError as e:
+            log(f"Could not write student ID cache: {e}")
+    return cache[key]
+
+def notion_timestamp() -> str:
+    """Current UTC time in the ISO 8601 form Notion's Date property takes."""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
 def notion_log(student_email:str, assignment_title:str, score:int, feedback:str,
-               topic_id:str):
+               topic_id:str, student_lookup=None, timestamp:str=None):
     """
     Log grading results to Notion database if credentials are available.
     Silently skips logging if any required credentials are missing.
+
+    student_lookup is an optional future from find_student_page that was
+    started earlier, e.g. while the submission was being graded. timestamp
+    is when the grade was given, from notion_timestamp(); defaults to now.
     """
-    # Use the globally defined Notion credentials
-    key   = NOTION_API_KEY
-    db_gr = NOTION_GRADES_DATABASE_ID
-    db_st = NOTION_STUDENTS_DATABASE_ID
-    
+    key, db_gr, db_st = notion_credentials()
+
     # Skip if any credentials are missing
     if not all([key, db_gr, db_st]):
         log("Notion logging skipped - missing credentials")
@@ -498,25 +942,10 @@ def notion_log(student_email:str, assignment_title:str, score:int, feedback:str,
     log(f"Notion credentials validated - proceeding with student lookup for {student_email}")
 
     # resolve student page ID
-    headers = {
-        "Authorization": f"Bearer {key}",
-        "Notion-Version": "2022-06-28",
-        "Content-Type": "application/json"
-    }
-    qurl = f"https://api.notion.com/v1/databases/{db_st}/query"
-    student_page_id = None
-    cursor = None
-    while True:
-        body = {"start_cursor": cursor} if cursor else {}
-        resp = requests.post(qurl, headers=headers, json=body).json()
-        for page in resp.get("results", []):
-            if (page["properties"]
-                    .get("Email", {})
-                    .get("email", "")
-                    .lower() == student_email.lower()):
-                student_page_id = page["id"]; break
-        if student_page_id or not resp.get("has_more"): break
-        cursor = resp.get("next_cursor")
+    if student_lookup is not None:
+        student_page_id = student_lookup.result()
+    else:
+        student_page_id = find_student_page(student_email)
     
     if not student_page_id:           # don't crash grader on lookup failure
         log(f"Student not found in Notion database: {student_email}")
@@ -529,7 +958,7 @@ def notion_log(student_email:str, assignment_title:str, score:int, feedback:str,
         "properties": {
             "Name":   {"title":  [{"text": {"content": assignment_title}}]},
             "Student":{"relation":[{"id": student_page_id}]},
-            "Date":   {"date":   {"start": datetime.utcnow().isoformat()}},
+            "Date":   {"date":   {"start": timestamp or notion_timestamp()}},
             "Total":  {"number": 100},
             "Score":  {"number": score},
             "Notes":  {"rich_text":[{"text": {"content": feedback[:1900]}}]},
@@ -538,8 +967,8 @@ def notion_log(student_email:str, assignment_title:str, score:int, feedback:str,
     }
     
     log(f"Creating Notion grade entry for {assignment_title} with score: {score}")
-    response = requests.post("https://api.notion.com/v1/pages",
-                  headers=headers, json=payload)
+    response = notion_session().post("https://api.notion.com/v1/pages", data=json_dumps(payload),
+                            timeout=NOTION_TIMEOUT)
     
     if response.status_code == 200:
         log(f"Successfully created Notion grade entry")
@@ -548,9 +977,139 @@ def notion_log(student_email:str, assignment_title:str, score:int, feedback:str,
 # ------------------------------------------------------------
 # Main grading logic
 # ------------------------------------------------------------
+# Default prompts
+DEFAULT_SYSTEM_PROMPT = (
+    "You are an auto‑grader for student programming assignments.\n"
+    "Decide whether the code meets the assignment requirements and\n"
+    "respond ONLY with minified JSON of the form\n"
+    '{"verdict": "yes" or "no", "feedback": "..."}; no extra text.\n')
+DEFAULT_EVAL_PROMPT = "Does this code meet the assignment requirements? Return the JSON verdict and feedback."
+DEFAULT_PASS_PROMPT = "You are a kind mentor. Give one upbeat sentence of praise."
+DEFAULT_FAIL_PROMPT = ("You are a kind mentor. In <=2 short sentences explain "
+          "why the code might not meet requirements. Keep it friendly for an 11‑yo.")
+
+# Layout of the system message; only the config-supplied prompts vary
+SYSTEM_MSG_TEMPLATE = (
+    "{system_prompt}\n\n"
+    "## Assignment instructions\n{assignment_prompt}\n\n"
+    "{evaluation_prompt}\n\n"
+    '## Feedback\nIf the verdict is "yes": {pass_prompt}\n'
+    'If the verdict is "no": {fail_prompt}\n\n'
+    # Spelled out too for models or proxies that ignore the schema
+    "## Response\nReply with a JSON object, verdict first: "
+    '{{"verdict": "yes" or "no", "feedback": "..."}}'
+)
+
+# Output cap for one graded submission: the verdict JSON plus at most two
+# short sentences of feedback. Override with "max_output_tokens" in the config.
+GRADE_MAX_TOKENS = 200
+
+# A passing reply needs nothing after its verdict (the praise is picked
+# locally), so the stream is cut as soon as this prefix has arrived
+PASS_VERDICT = re.compile(r'\s*\{\s*"verdict"\s*:\s*"yes"', re.I)
+VERDICT_FIELD = re.compile(r'"verdict"\s*:\s*"(\w+)"', re.I)
+
+# The only per-student part of a grading request; the code is appended
+# as-is, with no formatting pass over it
+USER_MSG_PREFIX = "## Student submission\n"
+
+# Praise for passing code carries no per-student detail, so it is picked
+# locally instead of spending model output tokens on it
+PRAISE_PHRASES = [
+    "Great job — your code meets all the requirements!",
+    "Nicely done! Your solution works as asked.",
+    "Excellent work — you nailed this one.",
+    "Well done! Your program does exactly what the assignment asked for.",
+    "Awesome job — your code hits every requirement.",
+    "Fantastic! You solved this one cleanly.",
+    "Way to go — your solution is spot on.",
+    "Super work! Everything the assignment asked for is there.",
+    "Brilliant — your code does the job nicely.",
+    "You did it! Your program meets the requirements.",
+    "Terrific effort — your solution checks all the boxes.",
+    "Great thinking! Your code works just as it should.",
+    "Impressive work — this solution meets the brief.",
+    "Nice one! Your program is right on target.",
+    "Excellent! You put all the pieces together correctly.",
+    "Good stuff — your code meets every requirement.",
+    "Well played! Your solution does what was asked.",
+    "Outstanding job — keep coding like this!",
+    "Great work! Your program shows you understood the task.",
+    "Perfect — your solution meets the assignment goals.",
+]
+
+def build_system_msg(cfg:dict) -> str:
+    """
+    Build the system message from the config, falling back to defaults.
+
+    Everything but the student code is identical for every submission of
+    an assignment, so it leads the request as a stable prefix that OpenAI's
+    automatic prompt caching can reuse. Only the code varies.
+    """
+    # Use prompts from config if available, otherwise use defaults
+    return SYSTEM_MSG_TEMPLATE.format_map({
+        "system_prompt": cfg.get("system_prompt", DEFAULT_SYSTEM_PROMPT).strip(),
+        "assignment_prompt": cfg.get("assignment_prompt", "").strip(),
+        "evaluation_prompt": cfg.get("evaluation_prompt", DEFAULT_EVAL_PROMPT).strip(),
+        "fail_prompt": cfg.get("feedback_prompt_fail", DEFAULT_FAIL_PROMPT),
+        "pass_prompt": (cfg.get("feedback_prompt_pass", DEFAULT_PASS_PROMPT)
+                        if not cfg.get("template_praise", True) else "leave feedback empty."),
+    })
+
+def parse_response(raw:str):
+    """Split a model reply into (verdict, feedback)."""
+    try:
+        result = json_loads(raw)
+        yn = str(result.get("verdict", "")).strip().lower()
+        feedback = str(result.get("feedback", "")).strip()
+    except (ValueError, AttributeError):
+        # Malformed or cut-short JSON - use the verdict if it got that far,
+        # otherwise fall back to the plain yes/no heuristic
+        log(f"Could not parse JSON response, falling back to yes/no: {raw[:50]}...")
+        match = VERDICT_FIELD.search(raw)
+        yn = match.group(1).lower() if match else raw.lower()
+        feedback = ""
+    return yn, feedback
+
+def score_verdict(yn:str, feedback:str, template_praise:bool=True):
+    """
+    Turn a verdict and feedback into (passed, grade, student-facing feedback).
+
+    Passing code gets a stock praise phrase unless template_praise is off,
+    in which case the model's own praise is kept.
+    """
+    # Process the yes/no verdict
+    unexpected_response = None
+    if yn.startswith("y"):
+        passed = True
+        grade_val = 100
+    elif yn.startswith("n"):
+        passed = False
+        grade_val = 50
+    else:
+        # Unexpected response
+        passed = False
+        grade_val = 50
+        unexpected_response = f"⚠️ Note: The grader received an unexpected response: '{yn}'. Expected 'yes' or 'no'."
+
+    if passed and (template_praise or not feedback):
+        feedback = random.choice(PRAISE_PHRASES)
+    elif not feedback:
+        feedback = "Unable to generate detailed feedback. Please review your code."
+
+    # Prepend the appropriate emoji based on pass/fail
+    feedback = "✅ " + feedback if passed else "❓ " + feedback
+
+    # Append unexpected response warning if applicable
+    if unexpected_response:
+        feedback = f"{feedback}\n\n{unexpected_response}"
+
+    return passed, grade_val, feedback
+
 def grade(config_path="autograde_config.json",
           local_override_email=None,
-          override_model=None):
+          override_model=None,
+          use_cache=True):
     """
     Main grading function that evaluates student code and provides feedback.
     
@@ -558,6 +1117,7 @@ def grade(config_path="autograde_config.json",
         config_path: Path to the config JSON file
         local_override_email: Optional email override for local testing
         override_model: Optional model override for the OpenAI API
+        use_cache: Reuse on-disk responses for identical requests
     """
     # Start timer for elapsed time tracking
     start_time = perf_counter()
@@ -566,117 +1126,331 @@ def grade(config_path="autograde_config.json",
     
     # Load configuration and student code
     cfg = load_config(config_path)
-    code = load_code(cfg["files"])
-    prompt = cfg.get("assignment_prompt", "")
+    code = load_code(cfg["files"], cfg.get("strip_comments", True),
+                     cfg.get("max_chars_per_file"))
     assignment_title = cfg.get("assignment_title", "Codio Assignment")
     topic_id = cfg.get("grade_topic_id", "")
     
     log(f"Loaded assignment: {assignment_title}")
     log(f"Files to grade: {cfg['files']}")
-    
-    # Get prompts from config or use defaults
-    default_system_prompt = """\
-        You are an auto‑grader for student programming assignments.
-        Respond ONLY with "yes" or "no" (lowercase) when asked if code
-        meets the assignment requirements; no extra text.
-    """
-    default_eval_prompt = "Does this code meet the assignment requirements? Answer only 'yes' or 'no'."
-    
-    # Use prompts from config if available, otherwise use defaults
-    system_msg = cfg.get("system_prompt", default_system_prompt)
-    evaluation_prompt = cfg.get("evaluation_prompt", default_eval_prompt)
-    
-    user_msg = textwrap.dedent(f"""\
-        ## Assignment instructions
-        {prompt}
 
-        ## Student submission
-        {code}
+    system_msg = build_system_msg(cfg)
+    template_praise = cfg.get("template_praise", True)
+    user_msg = USER_MSG_PREFIX + code
 
-        {evaluation_prompt}
-    """)
+    # In Codio, resolve the student's Notion page while the model grades;
+    # the lookup doesn't depend on the grade
+    student_lookup = None
+    if in_codio():
+        email = (local_override_email or
+                codio_env().get("student", {}).get("email", "unknown@nowhere"))
+        if all(notion_credentials()):
+            student_lookup = _notion_executor.submit(find_student_page, email)
 
     try:
-        # Call OpenAI API for grading
-        yn = call_openai(system_msg, user_msg, override_model).lower()
+        # Single OpenAI call returns both the verdict and the feedback.
+        # Stream it locally; Codio only needs the complete string.
+        raw = call_openai(system_msg, user_msg, override_model, use_cache,
+                          stream=not in_codio(),
+                          max_tokens=cfg.get("max_output_tokens", GRADE_MAX_TOKENS),
+                          response_format=GRADE_RESPONSE_FORMAT,
+                          stop_when=PASS_VERDICT.match if template_praise else None)
     except Exception as e:
         # Graceful failure path so students are not blocked
         error_msg = f"⚠️ Autograder API error: {e}"
         if in_codio():
             codio_send(0, error_msg)
+            if student_lookup is not None and not student_lookup.done():
+                # Nothing will be logged, and the executor thread would be
+                # joined at exit - leave without waiting for the lookup
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(0)
         else:
             print("ERROR contacting OpenAI API:", e, file=sys.stderr)
             print("Make sure your API key has access to the models needed.")
         return
 
-    # Process the yes/no response
-    if yn.startswith("y"):
-        passed = True
-        grade_val = 100
-    elif yn.startswith("n"):
-        passed = False
-        grade_val = 50
-    else:
-        # Unexpected response
-        passed = False
-        grade_val = 50
-        unexpected_response = f"⚠️ Note: The grader received an unexpected response: '{yn}'. Expected 'yes' or 'no'."
-
-    # Generate feedback
-    if passed:
-        default_pass_prompt = "You are a kind mentor. Give one upbeat sentence of praise."
-        feedback_system_msg = cfg.get("feedback_prompt_pass", default_pass_prompt)
-        feedback_user_msg = code
-    else:
-        default_fail_prompt = ("You are a kind mentor. In <=2 short sentences explain "
-                  "why the code might not meet requirements. Keep it friendly for an 11‑yo.")
-        feedback_system_msg = cfg.get("feedback_prompt_fail", default_fail_prompt)
-        feedback_user_msg = code
-
-    try:
-        feedback = call_openai(feedback_system_msg, feedback_user_msg, override_model)
-        # Prepend the appropriate emoji based on pass/fail
-        feedback = "✅ " + feedback if passed else "❓ " + feedback
-        
-        # Append unexpected response warning if applicable
-        if 'unexpected_response' in locals():
-            feedback = f"{feedback}\n\n{unexpected_response}"
-    except Exception as e:
-        feedback = "Unable to generate detailed feedback. Please review your code."
-        print(f"Error generating feedback: {e}", file=sys.stderr)
+    yn, feedback = parse_response(raw)
+    if yn.startswith("n") and not feedback:
+        # The reply lost its feedback (malformed or cut-short JSON); ask for
+        # it separately, as the grader did before the calls were combined
+        log("No feedback in reply, requesting it separately")
+        try:
+            feedback = call_openai(cfg.get("feedback_prompt_fail", DEFAULT_FAIL_PROMPT),
+                                   user_msg, override_model, use_cache,
+                                   max_tokens=cfg.get("max_output_tokens", GRADE_MAX_TOKENS))
+        except Exception as e:
+            print(f"Error generating feedback: {e}", file=sys.stderr)
+    passed, grade_val, feedback = score_verdict(yn, feedback, template_praise)
 
     # Deliver results
     if in_codio():
+        # Log to Notion in the background so it doesn't hold up the grade
+        log(f"Logging to Notion for student: {email}")
+        notion_job = _notion_executor.submit(notion_log, email, assignment_title,
+                                             grade_val, feedback, topic_id,
+                                             student_lookup, notion_timestamp())
         ok = codio_send(grade_val, feedback)
-        
-        # Log to Notion if in Codio environment
-        env = json.loads(os.getenv("CODIO_AUTOGRADE_ENV"))
-        email = (local_override_email or
-                env.get("student", {}).get("email", "unknown@nowhere"))
+
+        # Bounded wait so the process doesn't exit mid-request
         try:
-            log(f"Logging to Notion for student: {email}")
-            notion_log(email, assignment_title, grade_val, feedback, topic_id)
+            notion_job.result(timeout=NOTION_WAIT_SECONDS)
+        except FutureTimeout:
+            log(f"Notion logging still running after {NOTION_WAIT_SECONDS}s")
         except Exception as e:
             # non-fatal
             print("Notion log failed:", e, file=sys.stderr)
             log(f"Notion logging failed: {str(e)}")
-            
+        _notion_executor.shutdown(wait=False, cancel_futures=True)
+
+        if not notion_job.done():
+            # Executor threads are joined at interpreter exit, which would
+            # undo the bounded wait above - leave without them
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0 if ok else 1)
         sys.exit(0 if ok else 1)
     else:
         # Calculate elapsed time
         elapsed_time = perf_counter() - start_time
         
         # Local test mode
-        print(json.dumps({
+        sys.stdout.buffer.write(json_dumps({
             "grade": grade_val,
             "feedback": feedback,
             "passed": passed,
             "elapsed_seconds": round(elapsed_time, 2)
-        }, indent=2))
+        }, indent=True) + b"\n")
+        sys.stdout.flush()
         
         # Print timing info to stderr
         print(f"Elapsed time: {elapsed_time:.2f} seconds", file=sys.stderr)
 
+# ------------------------------------------------------------
+# Batch grading - many submissions share one request so the assignment
+# prefix is paid for once per batch instead of once per student
+# ------------------------------------------------------------
+BATCH_TOKEN_BUDGET = 8000     # student code per request, in estimated tokens
+BATCH_CONCURRENCY = 4         # batch requests in flight at once
+
+BATCH_INSTRUCTIONS = (
+    "## Batch grading\n"
+    "The user message contains several submissions, each starting with a "
+    "label such as ### [S1]. Grade each one independently and, instead of a "
+    "single verdict, respond ONLY "
+    'with minified JSON of the form {"results": [{"id": "S1", "verdict": '
+    '"yes" or "no", "feedback": "..."}]} with one entry per submission.'
+)
+
+def estimate_tokens(text:str) -> int:
+    """Rough token count (~4 characters per token for English and code)."""
+    return len(text) // 4 + 1
+
+def load_submissions(batch_dir:str, file_list, strip_comments:bool=True,
+                     max_chars:int=None) -> dict:
+    """
+    Collect submissions from batch_dir, where every subdirectory is one
+    student (named by e-mail or ID) holding the assignment files by name.
+    """
+    submissions = {}
+    for sub in sorted(pathlib.Path(batch_dir).iterdir()):
+        if not sub.is_dir():
+            continue
+        try:
+            submissions[sub.name] = load_code(
+                [str(sub / pathlib.Path(fn).name) for fn in file_list], strip_comments,
+                max_chars)
+        except FileNotFoundError as e:
+            print(f"Skipping {sub.name}: {e}", file=sys.stderr)
+    return submissions
+
+def _batch_chunks(submissions:dict, budget:int=BATCH_TOKEN_BUDGET):
+    """Split submissions into lists of (student_id, code) within the budget."""
+    chunk, size = [], 0
+    for student_id, code in submissions.items():
+        tokens = estimate_tokens(code)
+        if chunk and size + tokens > budget:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append((student_id, code))
+        size += tokens
+    if chunk:
+        yield chunk
+
+def _grade_one(system_msg:str, code:str, model, use_cache:bool,
+               max_tokens:int, template_praise:bool=True) -> dict:
+    """Grade a single submission, returning its result entry."""
+    try:
+        raw = call_openai(system_msg, USER_MSG_PREFIX + code, model,
+                          use_cache, max_tokens=max_tokens,
+                          response_format=GRADE_RESPONSE_FORMAT)
+    except Exception as e:
+        return {"grade": 0, "feedback": f"⚠️ Autograder API error: {e}", "passed": False}
+    passed, grade_val, feedback = score_verdict(*parse_response(raw), template_praise)
+    return {"grade": grade_val, "feedback": feedback, "passed": passed}
+
+def grade_batch(config_path:str, submissions:dict, override_model=None,
+                use_cache=True, concurrency:int=BATCH_CONCURRENCY) -> dict:
+    """
+    Grade many submissions with as few requests as possible.
+
+    Args:
+        config_path: Path to the config JSON file
+        submissions: Mapping of student ID to submitted code
+        override_model: Optional model override for the OpenAI API
+        use_cache: Reuse on-disk responses for identical requests
+        concurrency: How many batch requests may be in flight at once
+
+    Returns a mapping of student ID to {"grade", "feedback", "passed"}.
+    """
+    cfg = load_config(config_path)
+    system_msg = build_system_msg(cfg)
+    template_praise = cfg.get("template_praise", True)
+    batch_msg = f"{system_msg}\n\n{BATCH_INSTRUCTIONS}"
+    max_tokens = cfg.get("max_output_tokens", GRADE_MAX_TOKENS)
+
+    def grade_chunk(chunk) -> dict:
+        labels = {f"S{i}": sid for i, (sid, _) in enumerate(chunk, 1)}
+        user_msg = "\n\n".join(f"### [S{i}]\n{code}"
+                                for i, (_, code) in enumerate(chunk, 1))
+        log(f"Grading batch of {len(chunk)} submissions")
+        try:
+            raw = call_openai(batch_msg, user_msg, override_model, use_cache,
+                              max_tokens=max_tokens * len(chunk),
+                              response_format=BATCH_RESPONSE_FORMAT)
+            entries = json_loads(raw)["results"]
+            if not isinstance(entries, list):
+                log("Batch reply has no results list, grading individually")
+                entries = []
+        except Exception as e:
+            log(f"Batch request failed, grading individually: {e}")
+            entries = []
+
+        results = {}
+        for entry in entries:
+            sid = labels.get(str(entry.get("id", "")).strip("[]")) if isinstance(entry, dict) else None
+            if sid is None or sid in results:
+                continue
+            passed, grade_val, feedback = score_verdict(
+                str(entry.get("verdict", "")).strip().lower(),
+                str(entry.get("feedback", "")).strip(), template_praise)
+            results[sid] = {"grade": grade_val, "feedback": feedback, "passed": passed}
+
+        # Anything the batch reply missed is graded on its own
+        for sid, code in chunk:
+            if sid not in results:
+                log(f"No batch result for {sid}, grading individually")
+                results[sid] = _grade_one(system_msg, code, override_model, use_cache,
+                                          max_tokens, template_praise)
+        return results
+
+    # The requests are network-bound and independent, so overlap them
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for chunk_results in pool.map(grade_chunk, _batch_chunks(submissions)):
+            results.update(chunk_results)
+    return results
+
+# ------------------------------------------------------------
+# Offline grading through the OpenAI Batch API - half the token price in
+# exchange for results within 24h, for re-grading a class overnight
+# ------------------------------------------------------------
+BATCH_DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def grade_batch_api(config_path:str, submissions:dict, override_model=None,
+                    poll_interval:float=10, max_poll_interval:float=300) -> dict:
+    """
+    Grade submissions with one Batch API request each and wait for the results.
+
+    Args:
+        config_path: Path to the config JSON file
+        submissions: Mapping of student ID to submitted code
+        override_model: Optional model override for the OpenAI API
+        poll_interval: Seconds before the first status check; doubles each time
+        max_poll_interval: Upper bound for the wait between status checks
+
+    Returns a mapping of student ID to {"grade", "feedback", "passed"}.
+    """
+    cfg = load_config(config_path)
+    system_msg = build_system_msg(cfg)
+    template_praise = cfg.get("template_praise", True)
+    model = override_model or DEFAULT_MODEL
+
+    lines = []
+    for student_id, code in submissions.items():
+        lines.append(json_dumps({
+            "custom_id": student_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [
+                    {"role": "system", "content": system_msg},
+                    {"role": "user", "content": USER_MSG_PREFIX + code}
+                ],
+                "temperature": 0.1,
+                "max_tokens": cfg.get("max_output_tokens", GRADE_MAX_TOKENS),
+                "response_format": GRADE_RESPONSE_FORMAT
+            }
+        }))
+
+    batch_file = openai_client().files.create(
+        file=("grading_batch.jsonl", b"\n".join(lines)), purpose="batch")
+    batch = openai_client().batches.create(input_file_id=batch_file.id,
+                                         endpoint="/v1/chat/completions",
+                                         completion_window="24h")
+    print(f"Submitted batch {batch.id} with {len(lines)} submissions", file=sys.stderr)
+
+    delay = poll_interval
+    while batch.status not in BATCH_DONE_STATUSES:
+        time.sleep(delay)
+        delay = min(delay * 2, max_poll_interval)
+        batch = openai_client().batches.retrieve(batch.id)
+        log(f"Batch {batch.id} status: {batch.status}")
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} ended with status: {batch.status}")
+
+    results = {}
+    output = openai_client().files.content(batch.output_file_id).text if batch.output_file_id else ""
+    for line in output.splitlines():
+        item = json_loads(line)
+        try:
+            raw = item["response"]["body"]["choices"][0]["message"]["content"].strip()
+        except (KeyError, IndexError, TypeError):
+            continue
+        passed, grade_val, feedback = score_verdict(*parse_response(raw), template_praise)
+        results[item["custom_id"]] = {"grade": grade_val, "feedback": feedback, "passed": passed}
+
+    # Requests that errored inside the batch have no usable response
+    for student_id in submissions:
+        if student_id not in results:
+            results[student_id] = {"grade": 0, "passed": False,
+                                   "feedback": "⚠️ Autograder API error: no result in batch output"}
+    return results
+
+def notion_log_results(config_path:str, results:dict):
+    """
+    Record batch results in Notion, one grade entry per student.
+
+    Student IDs are the submission directory names, so only those that are
+    e-mail addresses can be matched to a student page.
+    """
+    cfg = load_config(config_path)
+    assignment_title = cfg.get("assignment_title", "Codio Assignment")
+    topic_id = cfg.get("grade_topic_id", "")
+    graded_at = notion_timestamp()      # the whole class was graded in one run
+    for student_id, result in results.items():
+        if "@" not in student_id:
+            print(f"Not logging {student_id} to Notion: not an e-mail address", file=sys.stderr)
+            continue
+        try:
+            notion_log(student_id, assignment_title, result["grade"], result["feedback"],
+                       topic_id, timestamp=graded_at)
+        except Exception as e:
+            # One failed entry shouldn't stop the rest of the class
+            print(f"Notion log failed for {student_id}: {e}", file=sys.stderr)
+
 # ------------------------------------------------------------
 if __name__ == "__main__":
     import argparse
@@ -686,6 +1460,36 @@ if __name__ == "__main__":
                    help="Path to autograde_config.json")
     ap.add_argument("--email", help="Override student e‑mail (local test)")
     ap.add_argument("--model", help="Override primary model (e.g., gpt-4o)")
+    ap.add_argument("--no-cache", action="store_true",
+                   help="Always call the API instead of reusing cached responses")
+    ap.add_argument("--batch-dir",
+                   help="Grade every student subdirectory of this folder in batched requests")
+    ap.add_argument("--batch", action="store_true",
+                   help="Send --batch-dir through the OpenAI Batch API (half price, up to 24h)")
+    ap.add_argument("-j", "--concurrency", type=int, default=BATCH_CONCURRENCY,
+                   help="Batch requests in flight at once for --batch-dir "
+                        f"(default {BATCH_CONCURRENCY}; lower it if you hit rate limits)")
+    ap.add_argument("--notion", action="store_true",
+                   help="Also log --batch-dir results to Notion (directories named by e-mail)")
     args = ap.parse_args()
-    grade(args.config, local_override_email=args.email, override_model=args.model)
+    if args.batch and not args.batch_dir:
+        ap.error("--batch requires --batch-dir")
+    if args.notion and not args.batch_dir:
+        ap.error("--notion requires --batch-dir")
+    if args.batch_dir:
+        cfg = load_config(args.config)
+        subs = load_submissions(args.batch_dir, cfg["files"], cfg.get("strip_comments", True),
+                                cfg.get("max_chars_per_file"))
+        if args.batch:
+            results = grade_batch_api(args.config, subs, override_model=args.model)
+        else:
+            results = grade_batch(args.config, subs, override_model=args.model,
+                                  use_cache=not args.no_cache, concurrency=args.concurrency)
+        sys.stdout.buffer.write(json_dumps(results, indent=True) + b"\n")
+        sys.stdout.flush()
+        if args.notion:
+            notion_log_results(args.config, results)
+    else:
+        grade(args.config, local_override_email=args.email, override_model=args.model,
+              use_cache=not args.no_cache)
 
@@ -1,4 +1,8 @@
-import os, pathlib
+import os, pathlib, re
+
+# KEY=value per line, optionally prefixed with "export" as in .env.template
+_ENV_LINE = re.compile(
+    r"[ \t]*(?:export[ \t]+)?([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t]*\r?\n?$")
 
 def load(env_path: str = ".env", verbose: bool = True):
     p = pathlib.Path(env_path)
@@ -6,11 +10,17 @@ def load(env_path: str = ".env", verbose: bool = True):
         if verbose:
             print(f"[load_env] {env_path} not found – skipping.")
         raise FileNotFoundError
-    for line in p.read_text().splitlines():
-        line = line.strip()
-        if not line or line.startswith("#") or "=" not in line:
-            continue
-        k, v = line.split("=", 1)
-        os.environ.setdefault(k, v)
+    parsed = {}
+    with p.open() as f:
+        for line in f:
+            m = _ENV_LINE.match(line)
+            if not m:                 # comments, blank lines
+                continue
+            k, v = m.groups()
+            if len(v) >= 2 and v[0] == v[-1] and v[0] in "\"'":
+                v = v[1:-1]
+            parsed.setdefault(k, v)       # first definition wins
+    # Variables already set in the environment take precedence
+    os.environ.update({k: v for k, v in parsed.items() if k not in os.environ})
     if verbose:
         print(f"[load_env] variables from {env_path} loaded.")